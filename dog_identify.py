@@ -1,70 +1,300 @@
 import os
+import math
 import time
 from copy import deepcopy
+from functools import partial
 import torch
 import torch.nn as nn
+from torch.nn.utils.fusion import fuse_linear_bn_eval, fuse_linear_bn_weights
 from torch.utils.data import DataLoader, Subset
 from torchvision.datasets import ImageFolder
-from torchvision import transforms
+from torchvision.transforms import v2
+from torchvision.io import read_file, decode_jpeg, decode_image, ImageReadMode
 from torchvision.models import efficientnet_v2_s
-from torch.cuda.amp import autocast, GradScaler
+from torch.amp import autocast, GradScaler
 import numpy as np
-from sklearn.model_selection import train_test_split
 from torch.utils.tensorboard import SummaryWriter
 
 
-writer = SummaryWriter(log_dir='runs/dog_breed_experiment_10')
+# 模块顶层只做轻量设置：DataLoader的spawn worker会重新import本文件，
+# 数据集、模型、优化器和SummaryWriter都在main()中创建
+os.environ['PYTORCH_CUDA_ALLOC_CONF'] = 'max_split_size_mb:128'  # 防止内存碎片（须在CUDA初始化之前设置）
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-os.environ['PYTORCH_CUDA_ALLOC_CONF'] = 'max_split_size_mb:128'  # 防止内存碎片
+torch.backends.cudnn.benchmark = True  # 输入固定为224x224，让cuDNN挑选最快的卷积算法
+
+
+def get_amp_dtype(device):
+    """
+    Ampere及以上使用BF16（动态范围与FP32相同，无需loss scaling），否则回退到FP16+GradScaler
+    including_emulation=False：只认原生BF16，V100/T4等旧卡走FP16而不是模拟BF16
+    """
+    if device.type == 'cuda' and torch.cuda.is_bf16_supported(including_emulation=False):
+        return torch.bfloat16
+    return torch.float16
+
+
 # ==============================
 # 数据增强及预处理
 # ==============================
-transform_train = transforms.Compose([
-    transforms.RandomResizedCrop(224, scale=(0.5, 1.0)),  # 扩大裁剪范围
-    transforms.RandomHorizontalFlip(p=0.6),
-    transforms.RandomVerticalFlip(p=0.3),
-    transforms.ColorJitter(brightness=0.5, contrast=0.5, saturation=0.4),
-    transforms.RandomAffine(degrees=20, translate=(0.15, 0.15)),
-    transforms.RandomApply([transforms.GaussianBlur(5)], p=0.4),
-    transforms.RandomSolarize(threshold=128, p=0.2),  # 新增光斑效果
-    transforms.ToTensor(),
-    transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
-    transforms.RandomErasing(p=0.4, scale=(0.03, 0.15), value='random')  # 随机颜色擦除
+norm_mean = [0.485, 0.456, 0.406]
+norm_std = [0.229, 0.224, 0.225]
+
+# 增强以uint8张量形式逐样本运行在GPU上（JPEG也在GPU上解码），不再经过PIL
+# 光斑和随机擦除不在这里逐样本做，而是在训练循环中由gpu_augment对整个batch一次完成
+transform_train = v2.Compose([
+    v2.RandomResizedCrop(224, scale=(0.5, 1.0), antialias=True),  # 扩大裁剪范围
+    v2.RandomHorizontalFlip(p=0.6),
+    v2.RandomVerticalFlip(p=0.3),
+    v2.ColorJitter(brightness=0.5, contrast=0.5, saturation=0.4),
+    v2.RandomAffine(degrees=20, translate=(0.15, 0.15)),
+    v2.RandomApply([v2.GaussianBlur(5)], p=0.4),
+    v2.ToDtype(torch.float32, scale=True),
+    v2.Normalize(norm_mean, norm_std),
 ])
 
-transform_test = transforms.Compose([
-    transforms.Resize(256),
-    transforms.CenterCrop(224),
-    transforms.ToTensor(),
-    transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+transform_test = v2.Compose([
+    v2.Resize(256, antialias=True),
+    v2.CenterCrop(224),
+    v2.ToDtype(torch.float32, scale=True),
+    v2.Normalize(norm_mean, norm_std)
 ])
 
 
+def collate_raw(batch):
+    """图片尺寸各异，原始JPEG字节保持为列表，只把标签拼成张量"""
+    data, targets = zip(*batch)
+    return list(data), torch.tensor(targets)
+
+
+def is_jpeg(data):
+    """按文件头魔数(0xFF 0xD8)判断，扩展名不可靠（存在以.jpg命名的PNG）"""
+    return data[:2].tolist() == [0xFF, 0xD8]
+
+
+def decode_batch(raw_batch, transform, device):
+    """批量解码图片字节并逐样本做变换，返回堆叠后的batch"""
+    if device.type == 'cuda':
+        images = [None] * len(raw_batch)
+        jpeg_idx = [i for i, data in enumerate(raw_batch) if is_jpeg(data)]
+        if jpeg_idx:
+            # nvJPEG批量解码
+            decoded = decode_jpeg([raw_batch[i] for i in jpeg_idx], mode=ImageReadMode.RGB, device=device)
+            for i, img in zip(jpeg_idx, decoded):
+                images[i] = img
+        # PNG/BMP/WebP等非JPEG文件在CPU上解码后再拷到GPU
+        for i, data in enumerate(raw_batch):
+            if images[i] is None:
+                images[i] = decode_image(data, mode=ImageReadMode.RGB).to(device)
+    else:
+        images = [decode_image(data, mode=ImageReadMode.RGB) for data in raw_batch]
+    return torch.stack([transform(img) for img in images])
+
+
+def solarize_params(device):
+    """
+    光斑在归一化空间中的逐通道阈值和翻转偏移：原始像素 x >= 128/255 时取 1 - x，
+    即 X >= (128/255 - mean) / std 时取 (1 - 2 * mean) / std - X
+    只需在训练开始时构建一次，避免每个batch都做一次阻塞的H2D拷贝
+    """
+    mean = torch.tensor(norm_mean, device=device).view(1, -1, 1, 1)
+    std = torch.tensor(norm_std, device=device).view(1, -1, 1, 1)
+    return (128 / 255 - mean) / std, (1 - 2 * mean) / std
+
+
+def gpu_augment(X, solarize_thr, solarize_offset, solarize_p=0.2, erase_p=0.4,
+                erase_scale=(0.03, 0.15), erase_ratio=(0.3, 3.3)):
+    """
+    对已归一化的整个batch做随机光斑(Solarize)和随机擦除(RandomErasing)
+    每个样本独立抽样，全部为向量化运算，不再逐样本调用
+    solarize_thr, solarize_offset: 由solarize_params预先构建
+    """
+    B, C, H, W = X.shape
+    dev = X.device
+
+    # 光斑
+    solarize = torch.rand(B, 1, 1, 1, device=dev) < solarize_p
+    X = torch.where(solarize & (X >= solarize_thr), solarize_offset - X, X)
+
+    # 随机擦除：每个样本随机一个矩形，填充标准正态噪声（同value='random'）
+    area = H * W * torch.empty(B, device=dev).uniform_(*erase_scale)
+    ratio = torch.empty(B, device=dev).uniform_(math.log(erase_ratio[0]), math.log(erase_ratio[1])).exp()
+    h = (area * ratio).sqrt().round().clamp(1, H)
+    w = (area / ratio).sqrt().round().clamp(1, W)
+    top = (torch.rand(B, device=dev) * (H - h + 1)).floor()
+    left = (torch.rand(B, device=dev) * (W - w + 1)).floor()
+    rows = torch.arange(H, device=dev).view(1, H, 1)
+    cols = torch.arange(W, device=dev).view(1, 1, W)
+    mask = ((rows >= top.view(B, 1, 1)) & (rows < (top + h).view(B, 1, 1))
+            & (cols >= left.view(B, 1, 1)) & (cols < (left + w).view(B, 1, 1))
+            & (torch.rand(B, 1, 1, device=dev) < erase_p))
+    return torch.where(mask.unsqueeze(1), torch.randn_like(X), X)
+
+
+class FusedEvalModel(nn.Module):
+    """EMA评估视图：引用原模型的features/avgpool，自带折叠后的分类头，前向与EfficientNet一致"""
+    def __init__(self, model, classifier):
+        super().__init__()
+        self.features = model.features
+        self.avgpool = model.avgpool
+        self.classifier = classifier
+
+    def forward(self, x):
+        x = self.features(x)
+        x = self.avgpool(x)
+        x = torch.flatten(x, 1)
+        return self.classifier(x)
+
+
 class ModelEMA:
-    def __init__(self, model, decay=0.999, total_epochs=50):
+    def __init__(self, model, decay=0.999, total_epochs=50, update_every=1):
         self.ema = deepcopy(model).eval()
         self.initial_decay = decay  # 初始衰减率
         self.min_decay = 0.995      # 最低衰减率
         self.total_epochs = total_epochs
+        # 每update_every次update才真正触碰参数，期间只累计 log(Πβ)
+        self.update_every = update_every
+        self.log_prod = 0.0
+        self.pending = 0
+        # deepcopy已带上当前参数，无需再逐个copy_同步
         for param in self.ema.parameters():
             param.requires_grad_(False)
 
-        # 初始参数同步
-        with torch.no_grad():
-            for ema_p, model_p in zip(self.ema.parameters(), model.parameters()):
-                ema_p.copy_(model_p)
+        # 只跟踪可训练参数（冻结层的EMA恒等于自身），列表缓存一次，热路径不再遍历模块
+        trainable = [model_p.requires_grad for model_p in model.parameters()]
+        self._ema_list = [p for p, t in zip(self.ema.parameters(), trainable) if t]
+        self._model_list = [p for p, t in zip(model.parameters(), trainable) if t]
+        # FP32主副本：EMA始终以FP32累加，FP32参数直接共享存储，无需每步转换
+        self.ema_params = [p.detach().float() for p in self._ema_list]
+        # 模型侧保持原dtype：_foreach_add_对FP32目标做混合精度加法时在kernel内部提升类型，不生成FP32临时副本
+        self.model_params = [p.detach() for p in self._model_list]
+
+        # EMA在独立CUDA流上计算，与下一个batch的前向重叠
+        self.ema_stream = torch.cuda.Stream() if self.ema_params[0].is_cuda else None
+        self.ema_done = torch.cuda.Event() if self.ema_stream is not None else None
+        # 模型参数快照（与模型同dtype）：主流随后可以立即修改参数，EMA读取的是快照
+        # 只有独立流路径需要快照，CPU上同步更新直接读取模型参数
+        self.snapshot = [p.clone() for p in self.model_params] if self.ema_stream is not None else None
+
+        # 评估专用视图：与ema共享特征层，分类头中的Linear→BatchNorm1d折叠为单个Linear
+        self.ema_eval = self._build_eval_model()
+
+    def _build_eval_model(self):
+        self.fused_pairs = []
+        classifier = getattr(self.ema, 'classifier', None)
+        # 不是 features→avgpool→classifier(Sequential) 结构时不折叠，直接用ema评估
+        if not (isinstance(classifier, nn.Sequential)
+                and hasattr(self.ema, 'features') and hasattr(self.ema, 'avgpool')):
+            return self.ema
+
+        head = list(classifier)
+        for i in range(len(head) - 1):
+            if isinstance(head[i], nn.Linear) and isinstance(head[i + 1], nn.BatchNorm1d):
+                fused = fuse_linear_bn_eval(head[i], head[i + 1])
+                self.fused_pairs.append((head[i], head[i + 1], fused))
+                head[i], head[i + 1] = fused, nn.Identity()
+        if not self.fused_pairs:
+            return self.ema
+        return FusedEvalModel(self.ema, nn.Sequential(*head)).eval()
 
     def update(self, model, current_epoch):
         # 线性衰减策略：从initial_decay降到min_decay
         decay = self.initial_decay - (self.initial_decay - self.min_decay) * (current_epoch / self.total_epochs)
         decay = max(decay, self.min_decay)  # 确保不低于最小值
+        self.log_prod += math.log(decay)
+        self.pending += 1
+        if self.pending >= self.update_every:
+            self._apply()
+
+    def _apply(self):
+        """
+        按闭式解一次性补上累计的衰减：
+        θ*_t = Πβ·θ*_s + Σ(1-β_i)Π_{j>i}β_j·θ_i，窗口内θ_i取当前参数时
+        后一项即 (1-Πβ)·θ_t，因此等价于用 decay=Πβ 做一次普通EMA
+        """
+        decay = math.exp(self.log_prod)
+        self.log_prod = 0.0
+        self.pending = 0
+        with torch.no_grad():
+            if self.ema_stream is None:
+                torch._foreach_mul_(self.ema_params, decay)
+                torch._foreach_add_(self.ema_params, self.model_params, alpha=1 - decay)
+                return
+
+            main_stream = torch.cuda.current_stream()
+            # 上一次EMA读完快照之后才能覆盖它（通常早已完成，不会阻塞）
+            main_stream.wait_event(self.ema_done)
+            # 快照在主流上拷贝，保证与后续optimizer.step的先后顺序
+            torch._foreach_copy_(self.snapshot, self.model_params)
+            self.ema_stream.wait_stream(main_stream)
+            with torch.cuda.stream(self.ema_stream):
+                # 单次foreach调用完成全部参数的 ema = decay * ema + (1 - decay) * model
+                torch._foreach_mul_(self.ema_params, decay)
+                torch._foreach_add_(self.ema_params, self.snapshot, alpha=1 - decay)
+                self.ema_done.record()
+
+    def sync(self):
+        """将FP32主副本写回ema模型（仅在评估/保存前调用）"""
+        if self.pending:
+            self._apply()  # 评估前补上尚未应用的衰减
+        if self.ema_stream is not None:
+            self.ema_stream.synchronize()
         with torch.no_grad():
-            for ema_param, model_param in zip(self.ema.parameters(), model.parameters()):
-                # 处理半精度参数
-                model_param_fp32 = model_param.detach().float()
-                ema_param_fp32 = ema_param.float()
-                ema_param_fp32.mul_(decay).add_(model_param_fp32, alpha=1 - decay)
-                ema_param.copy_(ema_param_fp32)
+            for ema_p, master in zip(self._ema_list, self.ema_params):
+                if ema_p.data_ptr() != master.data_ptr():  # 非FP32参数才需要回写
+                    ema_p.copy_(master)
+            # 按 W' = γ/σ·W, b' = γ/σ·(b-μ)+β 重新折叠，原地写入以保持参数地址不变
+            for linear, bn, fused in self.fused_pairs:
+                w, b = fuse_linear_bn_weights(linear.weight, linear.bias, bn.running_mean,
+                                              bn.running_var, bn.eps, bn.weight, bn.bias)
+                fused.weight.copy_(w)
+                fused.bias.copy_(b)
+
+
+class CUDAPrefetcher:
+    """
+    在独立CUDA流上提前把下一个batch拷贝到GPU，使H2D传输与当前batch的计算重叠
+    preprocess: 可选，对原始batch做解码/增强并放到device上（同样在预取流上执行）
+    非CUDA设备上退化为普通的逐batch处理
+    """
+    def __init__(self, loader, device, preprocess=None):
+        self.loader = loader
+        self.device = device
+        self.preprocess = preprocess
+        self.stream = torch.cuda.Stream() if device.type == 'cuda' else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _preload(self, it):
+        try:
+            X, y = next(it)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream):
+            return self._to_device(X), y.to(self.device, non_blocking=True)
+
+    def _to_device(self, X):
+        if self.preprocess is not None:
+            return self.preprocess(X)
+        return X.to(self.device, non_blocking=True)
+
+    def __iter__(self):
+        if self.stream is None:
+            for X, y in self.loader:
+                yield self._to_device(X), y.to(self.device)
+            return
+
+        it = iter(self.loader)
+        batch = self._preload(it)
+        while batch is not None:
+            current_stream = torch.cuda.current_stream()
+            current_stream.wait_stream(self.stream)
+            X, y = batch
+            # 张量在预取流上分配，需登记到计算流，防止被提前回收复用
+            X.record_stream(current_stream)
+            y.record_stream(current_stream)
+            batch = self._preload(it)
+            yield X, y
 
 
 # ==============================
@@ -72,24 +302,32 @@ class ModelEMA:
 # ==============================
 data_dir = './images/images'  # 请将数据集解压后的文件夹路径填写在此处
 
-# 分别创建两个 ImageFolder 实例，分别设置训练和验证时的变换
-full_dataset_train = ImageFolder(root=data_dir, transform=transform_train)
-full_dataset_val   = ImageFolder(root=data_dir, transform=transform_test)
+def stratified_split(targets, train_ratio=0.8):
+    """按类别分层随机划分，返回 (train_idx, val_idx)"""
+    targets = np.asarray(targets)
+    # 先打乱再稳定排序：同类样本连续排列，类内顺序随机
+    perm = np.random.permutation(len(targets))
+    order = perm[np.argsort(targets[perm], kind='stable')]
+    _, starts, counts = np.unique(targets[order], return_index=True, return_counts=True)
+    # 每个样本在所属类别内的名次，前 train_ratio 部分划入训练集
+    rank = np.arange(len(order)) - np.repeat(starts, counts)
+    is_train = rank < np.repeat((counts * train_ratio).astype(int), counts)
+    return np.random.permutation(order[is_train]).tolist(), np.random.permutation(order[~is_train]).tolist()
+
 
-# 获取所有样本标签用于分层划分
-all_targets = full_dataset_train.targets
+def load_datasets(data_dir):
+    """扫描数据目录并分层划分，返回 (train_set, val_set)"""
+    # 只扫描一次目录：数据集只读取原始JPEG字节，训练/验证的变换在预取阶段分别完成
+    full_dataset = ImageFolder(root=data_dir, loader=read_file)
 
-# 使用 train_test_split 进行分层划分，80%作为训练集，20%作为验证集
-train_idx, val_idx = train_test_split(
-    list(range(len(all_targets))),
-    test_size=0.2,
-    stratify=all_targets
-)
+    # 分层划分，80%作为训练集，20%作为验证集
+    train_idx, val_idx = stratified_split(full_dataset.targets, train_ratio=0.8)
 
-train_set = Subset(full_dataset_train, train_idx)
-val_set   = Subset(full_dataset_val, val_idx)
+    train_set = Subset(full_dataset, train_idx)
+    val_set   = Subset(full_dataset, val_idx)
 
-print(f"训练集: {len(train_set)} 个样本, 验证集: {len(val_set)} 个样本")
+    print(f"训练集: {len(train_set)} 个样本, 验证集: {len(val_set)} 个样本")
+    return train_set, val_set
 
 # ==============================
 # 定义网络模型（以 efficientnet_v2_s 为例）
@@ -113,125 +351,210 @@ def get_net(devices):
         torch.nn.SiLU(inplace=True),
         torch.nn.Linear(512, 120)
     )
-    return model.to(devices)
+    # channels_last(NHWC)让深度可分离卷积和1x1卷积走Tensor Core路径
+    return model.to(devices).to(memory_format=torch.channels_last)
 
-pretrained_net = get_net(device)
 
 # ==============================
 # 定义优化器和学习率调度器
 # ==============================
-# 修改优化器参数
-optimizer = torch.optim.AdamW(
-    [
-        {'params': pretrained_net.features[4:].parameters(), 'lr': 2e-5, 'weight_decay': 0.001},
-        {'params': pretrained_net.classifier[:-4].parameters(), 'lr': 5e-4, 'weight_decay': 0.003},
-        {'params': pretrained_net.classifier[-4:].parameters(), 'lr': 1e-3, 'weight_decay': 0.005}
-    ],
-    betas=(0.95, 0.999),
-    eps=1e-8  # 增加数值稳定性
-)
-
-# 修改调度器参数
-plateau_scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(
-    optimizer,
-    mode='max',
-    factor=0.3,     # 更温和的衰减幅度
-    patience=3,     # 缩短观察窗口
-    threshold=0.001 # 更敏感的阈值
-)
-
-cosine_scheduler = torch.optim.lr_scheduler.CosineAnnealingWarmRestarts(
-    optimizer,
-    T_0=12,        # 延长余弦周期到12个epoch
-    T_mult=2,       # 周期倍增
-    eta_min=1e-6
-)
+def get_optimizer(net, device):
+    # 修改优化器参数
+    return torch.optim.AdamW(
+        [
+            {'params': net.features[4:].parameters(), 'lr': 2e-5, 'weight_decay': 0.001},
+            {'params': net.classifier[:-4].parameters(), 'lr': 5e-4, 'weight_decay': 0.003},
+            {'params': net.classifier[-4:].parameters(), 'lr': 1e-3, 'weight_decay': 0.005}
+        ],
+        betas=(0.95, 0.999),
+        eps=1e-8,  # 增加数值稳定性
+        fused=device.type == 'cuda'  # 融合CUDA实现，一次kernel完成全部参数更新
+    )
+
+
+def get_schedulers(optimizer):
+    """返回 (plateau_scheduler, cosine_scheduler)"""
+    # 修改调度器参数
+    plateau_scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(
+        optimizer,
+        mode='max',
+        factor=0.3,     # 更温和的衰减幅度
+        patience=3,     # 缩短观察窗口
+        threshold=0.001 # 更敏感的阈值
+    )
+
+    cosine_scheduler = torch.optim.lr_scheduler.CosineAnnealingWarmRestarts(
+        optimizer,
+        T_0=12,        # 延长余弦周期到12个epoch
+        T_mult=2,       # 周期倍增
+        eta_min=1e-6
+    )
+    return plateau_scheduler, cosine_scheduler
 
 # ==============================
 # 定义评价函数
 # ==============================
-def evaluate_accuracy(data_iter, net, loss_fn, device=None, use_ema=False, ema_model=None):
+def evaluate_accuracy(data_iter, nets, loss_fn, device=None):
     """
-    计算验证集的准确率和损失
-    use_ema: 是否使用EMA模型
-    ema_model: EMA模型实例
+    一次遍历验证集，计算各模型的准确率和损失（如原模型和EMA模型共用一次解码）
+    nets: 模型列表
+    返回与nets一一对应的 [(acc, loss), ...]
     """
-    if device is None and isinstance(net, nn.Module):
-        device = next(net.parameters()).device
-
-    # 选择模型
-    if use_ema:
-        if ema_model is None:
-            raise ValueError("ema_model must be provided when use_ema is True")
-        model = ema_model.ema
-    else:
-        model = net
+    if device is None:
+        device = next(nets[0].parameters()).device
+    amp_dtype = get_amp_dtype(device)
+
+    for net in nets:
+        net.eval()
+
+    # inference_mode比no_grad更省（不跟踪view/版本号）；统计量留在GPU上，最后只同步一次
+    with torch.inference_mode():
+        # 每个模型一行：acc_sum, loss_sum
+        sums = torch.zeros(len(nets), 2, device=device)
+        n = 0
+        for X, y in data_iter:
+            X = X.to(device, non_blocking=True).to(memory_format=torch.channels_last)
+            y = y.to(device, non_blocking=True)
+            with autocast(device_type=device.type, dtype=amp_dtype, enabled=device.type == 'cuda'):
+                for i, net in enumerate(nets):
+                    output = net(X)
+                    loss = loss_fn(output, y)
+                    sums[i] += torch.stack([(output.argmax(dim=1) == y).sum(), loss * y.size(0)])
+            n += y.shape[0]
+    return [(acc_sum / n, loss_sum / n) for acc_sum, loss_sum in sums.tolist()]
 
-    model.eval()
 
-    acc_sum, loss_sum, n = 0.0, 0.0, 0
+def capture_train_step(net, loss_fn, params, X, y, scaler, accum_steps, amp_dtype, warmup=3):
+    """
+    把一次前向+反向捕获为CUDA Graph，返回 (graph, static_X, static_y, static_y_hat, static_l)
+    梯度预先分配为固定地址的张量，重放时反向直接累加到这些梯度上，
+    因此捕获后梯度只能原地清零（不能set_to_none）
+    预热用的是当前batch，结束后梯度和BN统计量（running_mean/var、num_batches_tracked）都会恢复
+    """
+    static_X = X.clone()
+    static_y = y.clone()
+    for p in params:
+        if p.grad is None:
+            p.grad = torch.zeros_like(p)
+
+    def step():
+        with autocast(device_type='cuda', dtype=amp_dtype):
+            static_y_hat = net(static_X)
+            static_l = loss_fn(static_y_hat, static_y) / accum_steps
+        scaler.scale(static_l).backward()
+        return static_y_hat, static_l
+
+    # 预热会更新BN的running统计量，先保存，预热后原地恢复（保持缓冲区地址不变）
+    buffers = list(net.buffers())
+    saved_buffers = [b.detach().clone() for b in buffers]
+
+    # 预热必须在旁路流上进行
+    side_stream = torch.cuda.Stream()
+    side_stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(side_stream):
+        for _ in range(warmup):
+            step()
+    torch.cuda.current_stream().wait_stream(side_stream)
+    # 预热产生的梯度和BN统计量都不计入训练
+    for p in params:
+        p.grad.zero_()
     with torch.no_grad():
-        for X, y in data_iter:
-            X, y = X.to(device), y.to(device)
-            with autocast():
-                output = model(X)
-                loss = loss_fn(output, y)
-            acc_sum += (output.argmax(dim=1) == y).float().sum().item()
-            loss_sum += loss.item() * y.size(0)
-            n += y.shape[0]
-    return acc_sum / n, loss_sum / n
+        for b, saved in zip(buffers, saved_buffers):
+            b.copy_(saved)
+
+    graph = torch.cuda.CUDAGraph()
+    with torch.cuda.graph(graph):
+        static_y_hat, static_l = step()
+    return graph, static_X, static_y, static_y_hat, static_l
 
 
 
 
-def train(train_iter, test_iter, net, loss, optimizer, device, num_epochs,
-          best_acc=0.0, accum_steps=4):
+def train(train_iter, test_iter, net, loss, optimizer, plateau_scheduler, cosine_scheduler,
+          writer, device, num_epochs, best_acc=0.0, accum_steps=4):
     best_metric = 0.0
     patience = 12
     no_improve = 0
     net = net.to(device)
-    scaler = GradScaler()
-    ema = ModelEMA(net)
+    params = [p for p in net.parameters() if p.requires_grad]  # 缓存参数列表，梯度裁剪时不再遍历模块
+    amp_dtype = get_amp_dtype(device)
+    # BF16下scaler被禁用：scale/unscale_/update为空操作，step直接调用optimizer.step
+    scaler = GradScaler(device.type, enabled=device.type == 'cuda' and amp_dtype == torch.float16)
+    ema = ModelEMA(net, update_every=4)  # 每4个优化步更新一次EMA
+    solarize_thr, solarize_offset = solarize_params(device)
+    # 输入形状固定，静态编译融合BN/激活与分类头；在EMA深拷贝之后原地编译，参数和state_dict不变
+    # 训练步由下面手动捕获CUDA Graph，编译时关闭Inductor自带的cudagraphs以免嵌套捕获
+    net.compile(mode='max-autotune-no-cudagraphs', dynamic=False)
+    ema.ema_eval.compile(mode='reduce-overhead', dynamic=False)
     # 记录当前使用的调度器
     current_scheduler = "cosine"
     print(f'training on {device} with accum_steps={accum_steps}')
 
+    # batch大小固定：预热graph_warmup步后把前向+反向捕获为CUDA Graph重放，消除逐算子的调度开销
+    use_graph = device.type == 'cuda'
+    graph_warmup = 20
+    graph = None
+    global_step = 0
+
     for epoch in range(num_epochs):
         net.train()
-        train_l_sum, train_acc_sum, n = 0.0, 0.0, 0
+        # 统计量留在GPU上累加，避免每个batch的.item()同步
+        train_l_sum = torch.zeros((), device=device)
+        train_acc_sum = torch.zeros((), device=device)
+        n = 0
         epoch_start = time.time()
         total_batches = len(train_iter)
 
         # 初始化进度跟踪变量
         batch_times = []
         progress_bar_length = 30
+        log_interval = 50  # 进度条上的loss/acc每50个batch才同步刷新一次
+        batch_loss, batch_acc = 0.0, 0.0
 
         for batch_idx, (X, y) in enumerate(train_iter):
             batch_start = time.time()
-            X, y = X.to(device), y.to(device)
-
-            # 混合精度前向
-            with autocast():
-                y_hat = net(X)
-                l = loss(y_hat, y) / accum_steps
+            X = X.to(device, non_blocking=True)
+            X = gpu_augment(X, solarize_thr, solarize_offset).to(memory_format=torch.channels_last)
+            y = y.to(device, non_blocking=True)
+
+            # 在累积窗口开头捕获，此时梯度刚被清空
+            if use_graph and graph is None and global_step >= graph_warmup and batch_idx % accum_steps == 0:
+                graph, static_X, static_y, static_y_hat, static_l = capture_train_step(
+                    net, loss, params, X, y, scaler, accum_steps, amp_dtype)
+            global_step += 1
+
+            if graph is not None and X.shape == static_X.shape:
+                static_X.copy_(X, non_blocking=True)
+                static_y.copy_(y, non_blocking=True)
+                graph.replay()
+                y_hat, l = static_y_hat, static_l
+            else:
+                # 混合精度前向（预热阶段及最后一个不完整的batch走eager）
+                with autocast(device_type=device.type, dtype=amp_dtype, enabled=device.type == 'cuda'):
+                    y_hat = net(X)
+                    l = loss(y_hat, y) / accum_steps
+                scaler.scale(l).backward()
 
             unscaled_loss = l.detach().clone() * accum_steps
-            scaler.scale(l).backward()
 
             # 梯度累积条件判断
             if (batch_idx + 1) % accum_steps == 0 or (batch_idx + 1) == total_batches:
                 scaler.unscale_(optimizer)
-                torch.nn.utils.clip_grad_norm_(net.parameters(), max_norm=2.0)  # 添加梯度裁剪
+                torch.nn.utils.clip_grad_norm_(params, max_norm=2.0, foreach=True)  # 添加梯度裁剪（foreach批量求范数和缩放）
                 scaler.step(optimizer)
                 scaler.update()
-                optimizer.zero_grad()
+                # 直接释放梯度，省去逐参数清零；捕获CUDA Graph后梯度地址必须固定，改为原地清零
+                optimizer.zero_grad(set_to_none=graph is None)
                 ema.update(net,epoch)
 
             # 统计指标
-            batch_acc = (y_hat.argmax(dim=1) == y).sum().item() / y.size(0)
-            train_l_sum += unscaled_loss.item() * y.size(0)
-            train_acc_sum += (y_hat.argmax(dim=1) == y).sum().item()
+            correct = (y_hat.argmax(dim=1) == y).sum()  # 只算一次，累加和进度条共用
+            train_l_sum += unscaled_loss * y.size(0)
+            train_acc_sum += correct
             n += y.size(0)
+            if batch_idx % log_interval == 0:
+                batch_loss = unscaled_loss.item()
+                batch_acc = correct.item() / y.size(0)
 
             # 计算进度和时间预估
             batch_time = time.time() - batch_start
@@ -252,18 +575,21 @@ def train(train_iter, test_iter, net, loss, optimizer, device, num_epochs,
             info = (f"Epoch {epoch + 1}/{num_epochs} |{progress_bar}| "
                     f"{completed}/{total_batches} batches "
                     f"[{elapsed:.0f}s<{remaining:.0f}s, {1 / avg_batch_time:.1f}batches/s] "
-                    f"Loss: {unscaled_loss.item():.4f} Acc: {batch_acc:.4f}")
+                    f"Loss: {batch_loss:.4f} Acc: {batch_acc:.4f}")
             print("\r" + info, end="")
 
         # 完成一个epoch后换行
         epoch_time = time.time() - epoch_start
         print(f"\rEpoch {epoch + 1} completed in {epoch_time:.1f}s".ljust(120))
+        # 每个epoch只同步一次
+        train_l_sum, train_acc_sum = torch.stack([train_l_sum, train_acc_sum]).tolist()
 
         # 验证阶段
-        test_acc, test_loss = evaluate_accuracy(test_iter, net, loss, device, use_ema=False, ema_model=ema)
+        ema.sync()  # 延迟同步：评估前再把主副本写回
+        (test_acc, test_loss), (ema_test_acc, ema_test_loss) = evaluate_accuracy(
+            test_iter, [net, ema.ema_eval], loss, device)
         print(f"  Train Loss: {train_l_sum / n:.4f}  Train Acc: {train_acc_sum / n:.4f}")
         print(f"  Val Loss (Original): {test_loss:.4f}  Val Acc (Original): {test_acc:.4f}")
-        ema_test_acc, ema_test_loss = evaluate_accuracy(test_iter, net, loss, device, use_ema=True, ema_model=ema)
         print(f"  Val Loss (EMA): {ema_test_loss:.4f}  Val Acc (EMA): {ema_test_acc:.4f}")
 
         # 动态切换调度策略
@@ -323,22 +649,45 @@ def train(train_iter, test_iter, net, loss, optimizer, device, num_epochs,
     return best_acc
 
 
-def train_fine_tuning(net, optimizer, batch_size=64, num_epochs=50):
+def train_fine_tuning(net, optimizer, plateau_scheduler, cosine_scheduler, writer,
+                      train_set, val_set, batch_size=64, num_epochs=50):
+    # 多进程加载：worker只负责读取文件字节，解码与数据增强在GPU上完成
+    num_workers = min(8, os.cpu_count() or 1)
     train_iter = DataLoader(
         train_set,
         batch_size,
         shuffle=True,
-        pin_memory=True,
+        collate_fn=collate_raw,
+        num_workers=num_workers,
+        persistent_workers=True,
+        prefetch_factor=4,
     )
+    # 验证不保留激活，可用更大的batch
     val_iter = DataLoader(
         val_set,
-        batch_size,
+        batch_size=128,
         shuffle=False,
-        pin_memory=True,
+        collate_fn=collate_raw,
+        num_workers=4,
+        persistent_workers=True,
     )
+    train_iter = CUDAPrefetcher(train_iter, device, partial(decode_batch, transform=transform_train, device=device))
+    val_iter = CUDAPrefetcher(val_iter, device, partial(decode_batch, transform=transform_test, device=device))
     loss_fn = nn.CrossEntropyLoss(label_smoothing=0.15)
-    best_acc = train(train_iter, val_iter, net, loss_fn, optimizer, device, num_epochs)
+    best_acc = train(train_iter, val_iter, net, loss_fn, optimizer, plateau_scheduler, cosine_scheduler,
+                     writer, device, num_epochs)
     return best_acc
 
+
+def main():
+    writer = SummaryWriter(log_dir='runs/dog_breed_experiment_10')
+    train_set, val_set = load_datasets(data_dir)
+    pretrained_net = get_net(device)
+    optimizer = get_optimizer(pretrained_net, device)
+    plateau_scheduler, cosine_scheduler = get_schedulers(optimizer)
+    train_fine_tuning(pretrained_net, optimizer, plateau_scheduler, cosine_scheduler, writer,
+                      train_set, val_set)
+
+
 if __name__ == '__main__':
-    train_fine_tuning(pretrained_net, optimizer)
+    main()